@@ -0,0 +1,120 @@
+"""
+Compare one shard with N shards for the question queries the app makes.
+
+Usage: python -m benchmarks.bench_shards [--questions 100000] [--shards 4]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flaskr import create_app, db, shards
+
+CATEGORIES = 6
+
+def build(directory, n_questions, count):
+    """
+    Create a database with n_questions synthetic questions, spread across
+    count shards. Return the shard paths.
+    """
+    database_path = os.path.join(directory, f"bench-{count}.sqlite")
+    conn = sqlite3.connect(database_path)
+    conn.executescript(shards.SCHEMA)
+    conn.executemany(shards.INSERT_QUESTION, (
+        (i, i % CATEGORIES + 1, f"Question number {i} about topic {i % 97}?",
+         f"Answer {i}", i % 5 + 1)
+        for i in range(1, n_questions + 1)
+    ))
+    conn.commit()
+    paths = shards.shard_paths(database_path, count)
+    shards.reshard(conn, [], paths)
+    conn.close()
+    return paths
+
+def timed(label, count, fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<24} {count:>3} shards  {elapsed * 1000:9.2f} ms")
+
+def bench_reads(paths, pool, repeat):
+    count = len(paths)
+    timed("all questions", count, lambda: shards.scatter(
+        paths, "SELECT * FROM question ORDER BY id", pool = pool
+    ), repeat)
+    timed("search", count, lambda: shards.scatter(
+        paths,
+        "SELECT * FROM question WHERE question LIKE '%topic 42%' "
+        "COLLATE NOCASE ORDER BY id",
+        pool = pool
+    ), repeat)
+    path = paths[shards.shard_for(3, count)]
+    timed("one category", count, lambda: shards.scatter(
+        [path], "SELECT * FROM question WHERE category_id == 3 ORDER BY id"
+    ), repeat)
+
+def bench_writes(directory, count, n_inserts, n_threads, batching):
+    """
+    Create questions from concurrent threads through the app's
+    POST /questions, so that ID allocation, the near-duplicate index and
+    (optionally) group commits are all included. Questions are spread
+    across count shard files, the same layout as the read benchmarks.
+    """
+    database_path = os.path.join(directory, f"bench-writes-{count}.sqlite")
+    app = create_app({
+        "TEST_DATABASE": database_path,
+        "SHARD_COUNT": count,
+        "WRITE_BATCHING": batching,
+    }, prod = False)
+    with app.app_context():
+        db.init_db()
+
+    def insert(worker):
+        client = app.test_client()
+        failed = 0
+        for i in range(n_inserts // n_threads):
+            res = client.post("/questions", json = {
+                "question": f"Benchmark question {uuid.uuid4().hex}?",
+                "answer": "Answer",
+                "category_id": (worker + i) % CATEGORIES + 1,
+                "difficulty": 1,
+            })
+            if not res.get_json()["success"]:
+                failed += 1
+        return failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = n_threads) as pool:
+        failed = sum(pool.map(insert, range(n_threads)))
+    elapsed = time.perf_counter() - start
+    label = "batched creates" if batching else "creates"
+    print(
+        f"{label:<24} {count:>3} shards  {n_inserts / elapsed:9.0f} /s"
+        f"  ({failed} failed)"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--questions", type = int, default = 100000)
+    parser.add_argument("--shards", type = int, default = 4)
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--inserts", type = int, default = 2000)
+    parser.add_argument("--threads", type = int, default = 8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for count in (1, args.shards):
+            paths = build(directory, args.questions, count)
+            with ThreadPoolExecutor(max_workers = count) as pool:
+                bench_reads(paths, pool, args.repeat)
+            for batching in (False, True):
+                bench_writes(
+                    directory, count, args.inserts, args.threads, batching
+                )
+
+if __name__ == "__main__":
+    main()
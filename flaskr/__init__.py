@@ -2,6 +2,8 @@ from flask import Flask, jsonify, request, abort
 import os
 import logging
 import random
+import sqlite3
+from concurrent.futures import TimeoutError
 
 logging.basicConfig(level = logging.DEBUG)
 
@@ -39,7 +41,53 @@ def create_app(test_config = None, prod = True):
     app.config.from_mapping(
         PROD_DATABASE = os.path.join(app.instance_path, "flaskr.sqlite"),
         TEST_DATABASE = os.path.join(app.instance_path, "test-flaskr.sqlite"),
+        PROD_SNAPSHOT = os.path.join(app.instance_path, "flaskr.snapshot"),
+        TEST_SNAPSHOT = os.path.join(app.instance_path, "test-flaskr.snapshot"),
+        # Serve reads from the memory-mapped snapshot when it has been built.
+        # It is rebuilt in the background after writes, so reads may lag
+        # slightly behind them.
+        USE_SNAPSHOT = False,
+        # Maximum concurrent requests per endpoint. Requests beyond the
+        # limit queue for up to ADMISSION_QUEUE_TIMEOUT seconds, and are
+        # shed with a 503 once ADMISSION_MAX_QUEUE requests are waiting.
+        ADMISSION_LIMITS = {"get_questions": 8, "play_quiz": 8},
+        ADMISSION_MAX_QUEUE = 16,
+        ADMISSION_QUEUE_TIMEOUT = 1.0,
+        ADMISSION_RETRY_AFTER = 1,
+        # Optional per-client (requests per second, burst) rate limit
+        RATE_LIMIT = None,
+        # Queue question inserts to a single writer thread, which commits
+        # up to WRITE_BATCH_SIZE of them at a time, waiting at most
+        # WRITE_BATCH_WINDOW seconds to fill a group
+        WRITE_BATCHING = False,
+        WRITE_BATCH_SIZE = 64,
+        WRITE_BATCH_WINDOW = 0.005,
+        # Seconds to wait for a group commit before answering 503
+        WRITE_TIMEOUT = 10,
+        # Spread questions across this many SQLite files by category (0 to
+        # keep them in the main database), querying up to SHARD_THREADS
+        # shards at once. Change it with the reshard command.
+        SHARD_COUNT = 0,
+        SHARD_THREADS = 8,
+        # Question IDs are leased from the main database in blocks of this
+        # many per process when sharded
+        SHARD_ID_BLOCK = 1000,
+        # Default and maximum number of /questions/suggest results, and how
+        # often (in seconds) to rebuild the index to pick up other workers'
+        # writes
+        SUGGEST_LIMIT = 10,
+        SUGGEST_MAX_LIMIT = 50,
+        SUGGEST_REFRESH = 60,
+        # Near-duplicate detection for new questions: "off", "flag" (create
+        # the question, but list its near-duplicates) or "reject". Questions
+        # are near-duplicates if their estimated similarity is at least
+        # DEDUP_THRESHOLD. Identical questions (up to case and whitespace) are
+        # always rejected.
+        DEDUP = "flag",
+        DEDUP_THRESHOLD = 0.7,
     )
+    if test_config is not None:
+        app.config.from_mapping(test_config)
 
     # Ensure the instance folder exists
     try:
@@ -47,8 +95,12 @@ def create_app(test_config = None, prod = True):
     except OSError:
         pass
 
-    from . import db
+    from . import admission, db, dedup, shards, snapshot, suggest, writer
     db.init_app(app)
+    dedup.init_app(app)
+    shards.init_app(app)
+    snapshot.init_app(app)
+    admission.init_app(app)
 
     @app.route("/")
     def hello():
@@ -96,12 +148,13 @@ def create_app(test_config = None, prod = True):
             # Filter on category and search text
             try:
                 query = (
-                    "SELECT * FROM question "
                     "WHERE question.category_id = "
                     f"{category_id[0][0]} "
                     f"AND question.question LIKE '%{search}%' COLLATE NOCASE"
                 )
-                res = cur.execute(query).fetchall()
+                res = shards.select_questions(
+                    query, category_id[0][0], prod = prod
+                )
             except:
                 conn.close()
                 abort(500)
@@ -109,11 +162,8 @@ def create_app(test_config = None, prod = True):
         elif search is not None:
             # Filter on search text only
             try:
-                query = (
-                    "SELECT * FROM question "
-                    f"WHERE question LIKE '%{search}%' COLLATE NOCASE"
-                )
-                res = cur.execute(query).fetchall()
+                query = f"WHERE question LIKE '%{search}%' COLLATE NOCASE"
+                res = shards.select_questions(query, prod = prod)
             except:
                 conn.close()
                 abort(500)
@@ -121,19 +171,17 @@ def create_app(test_config = None, prod = True):
         elif category is not None:
             # Filter on category only
             try:
-                query = (
-                    "SELECT * FROM question "
-                    "WHERE question.category_id = "
-                    f"{category_id[0][0]}"
+                query = f"WHERE question.category_id = {category_id[0][0]}"
+                res = shards.select_questions(
+                    query, category_id[0][0], prod = prod
                 )
-                res = cur.execute(query).fetchall()
             except:
                 conn.close()
                 abort(500)
 
         else:
             # No supplied parameters, just get all questions
-            res = cur.execute("SELECT * FROM question").fetchall()
+            res = shards.select_questions(prod = prod)
 
         # Subset the questions 
         questions = paginate_questions(res, page)
@@ -155,15 +203,44 @@ def create_app(test_config = None, prod = True):
             "categories": formatted_categories,
         })
 
+    @app.route("/questions/suggest")
+    def suggest_questions():
+        """
+        Get questions with words starting with the words of a prefix,
+        for autocomplete. E.g.,
+        GET /questions/suggest?prefix=tit
+        """
+        prefix = request.args.get("prefix", "", type = str)
+        limit = request.args.get(
+            "limit", app.config["SUGGEST_LIMIT"], type = int
+        )
+        if len(suggest.tokenize(prefix)) == 0 or limit < 1:
+            abort(400)
+        limit = min(limit, app.config["SUGGEST_MAX_LIMIT"])
+
+        suggestions = suggest.get_index(prod = prod).suggest(prefix, limit)
+        return jsonify({
+            "success": True,
+            "suggestions": [
+                {"id": id, "question": text} for id, text in suggestions
+            ],
+        })
+
     @app.route("/questions/<int:id>")
     def get_question(id):
+        # Serve from the snapshot if there is one
+        bank = snapshot.get_snapshot(prod = prod)
+        if bank is not None:
+            formatted_question = bank.get_question(id)
+            if formatted_question is None:
+                abort(404)
+            return jsonify({
+                "success": True,
+                "question": formatted_question,
+            })
+
         # Get the specific question by ID
-        conn = db.get_db(prod = prod)
-        cur = conn.cursor()
-        res = cur.execute(
-            f"SELECT * FROM question WHERE id == {id}"
-        ).fetchall()
-        conn.close()
+        res = shards.select_questions(f"WHERE id == {id}", prod = prod)
 
         # If there is no question at the requested ID,
         # abort with a 404 resource not found
@@ -182,22 +259,24 @@ def create_app(test_config = None, prod = True):
     @app.route("/questions/<int:id>", methods = ["DELETE"])
     def delete_question(id):
         # Confirm that the book exists
-        conn = db.get_db(prod = prod)
-        cur = conn.cursor()
-        res = cur.execute(
-            f"SELECT * FROM question WHERE id == {id}"
-        ).fetchall()
+        res = shards.select_questions(f"WHERE id == {id}", prod = prod)
 
         if len(res) == 0:
-            conn.close()
             abort(404)
 
+        # Connect to the shard holding the question
+        conn = shards.get_shard(res[0][1], prod = prod)
+        cur = conn.cursor()
+
         # Delete it
         try:
             res = cur.execute(
                 f"DELETE FROM question WHERE id == {id}"
             )
+            dedup.remove_question(conn, id)
             conn.commit()
+            snapshot.refresh_snapshot(prod = prod)
+            suggest.remove_question(id, prod = prod)
             conn.close()
             return jsonify({
                 "success": True,
@@ -220,6 +299,82 @@ def create_app(test_config = None, prod = True):
         category_id = body.get("category_id", None)
         difficulty = body.get("difficulty", None)
 
+        # Look for duplicates before inserting the question
+        dedup_entry = None
+        near_duplicates = []
+        if app.config["DEDUP"] != "off" and isinstance(question, str):
+            signature = dedup.signature(question)
+            exact, near = dedup.check(
+                question, signature, app.config["DEDUP_THRESHOLD"], prod = prod
+            )
+            near_duplicates = [id for id, score in near]
+            if len(exact) > 0:
+                return jsonify({
+                    "success": False,
+                    "error": 409,
+                    "message": "Question duplicates an existing question",
+                    "duplicates": exact,
+                })
+            if len(near) > 0 and app.config["DEDUP"] == "reject":
+                return jsonify({
+                    "success": False,
+                    "error": 409,
+                    "message": "Question is a near-duplicate of an existing question",
+                    "duplicates": near_duplicates,
+                })
+            # Indexed in the same transaction as the question
+            dedup_entry = (question, signature)
+
+        def created(created_id):
+            """
+            Index a newly created question, and return the response.
+            """
+            # Index the text as it was stored, even if it wasn't a string
+            suggest.add_question(created_id, str(question), prod = prod)
+            response = {
+                "success": True,
+                "created_id": created_id
+            }
+            if dedup_entry is not None:
+                response["near_duplicates"] = near_duplicates
+            return jsonify(response)
+
+        sharded = len(shards.get_shard_paths(prod = prod)) > 0
+        if app.config["WRITE_BATCHING"] or sharded:
+            values = (category_id, question, answer, difficulty)
+            try:
+                if sharded:
+                    # Take an ID from this process's lease, so that IDs are
+                    # unique across shards
+                    created_id = shards.allocate_id(prod = prod)
+                    values = (created_id,) + values
+                if app.config["WRITE_BATCHING"]:
+                    # Wait for the writer thread to commit our question's group
+                    future = writer.get_writer(
+                        category_id, prod = prod
+                    ).submit(*values, dedup_entry = dedup_entry)
+                    try:
+                        created_id = future.result(
+                            timeout = app.config["WRITE_TIMEOUT"]
+                        )
+                    except (TimeoutError, sqlite3.OperationalError):
+                        # The writer is backed up, or the database is locked.
+                        # (After a timeout, the question may still be created.)
+                        logging.warning("Question batch did not commit in time.")
+                        abort(503, retry_after = app.config["ADMISSION_RETRY_AFTER"])
+                else:
+                    shard = shards.get_shard(category_id, prod = prod)
+                    shard.execute(shards.INSERT_QUESTION, values)
+                    if dedup_entry is not None:
+                        dedup.add_question(shard, created_id, *dedup_entry)
+                    shard.commit()
+            except (sqlite3.Error, TypeError, ValueError):
+                logging.warning("Question could not be inserted.")
+                abort(400)
+            if not app.config["WRITE_BATCHING"]:
+                snapshot.refresh_snapshot(prod = prod)
+            return created(created_id)
+
         # Create the database connection and cursor
         conn = db.get_db(prod = prod)
         cur = conn.cursor()
@@ -229,6 +384,8 @@ def create_app(test_config = None, prod = True):
             res = cur.execute(
                 f'INSERT INTO question (category_id, question, answer, difficulty) VALUES ({category_id}, "{question}", "{answer}", {difficulty});'
             )
+            if dedup_entry is not None:
+                dedup.add_question(conn, cur.lastrowid, *dedup_entry)
             conn.commit()
         except:
             # If this hasn't worked, it's likely a bad request
@@ -241,11 +398,10 @@ def create_app(test_config = None, prod = True):
             new_question = cur.execute(
                 f"SELECT id FROM question WHERE question == '{question}'"
             ).fetchone()
+            snapshot.refresh_snapshot(prod = prod)
+            response = created(new_question[0])
             conn.close()
-            return jsonify({
-                "success": True,
-                "created_id": new_question[0]
-            })
+            return response
         except:
             # If this hasn't worked, it may be a server error
             logging.warning("Questions could not be retrieved.")
@@ -259,10 +415,14 @@ def create_app(test_config = None, prod = True):
         Get all categories
         """
         try:
-            conn = db.get_db(prod = prod)
-            cur = conn.cursor()
-            categories = cur.execute("SELECT * FROM category").fetchall()
-            conn.close()
+            bank = snapshot.get_snapshot(prod = prod)
+            if bank is not None:
+                categories = bank.categories()
+            else:
+                conn = db.get_db(prod = prod)
+                cur = conn.cursor()
+                categories = cur.execute("SELECT * FROM category").fetchall()
+                conn.close()
 
             formatted_categories= []
             for category in categories:
@@ -287,6 +447,21 @@ def create_app(test_config = None, prod = True):
         """
         Get questions in a supplied category.
         """
+        # Serve from the snapshot's category index if there is one
+        bank = snapshot.get_snapshot(prod = prod)
+        if bank is not None:
+            category = bank.category(id)
+            if category is None:
+                abort(404)
+            formatted_questions = bank.questions_in_category(id)
+            if len(formatted_questions) == 0:
+                abort(422)
+            return jsonify({
+                "success": True,
+                "current_category": category,
+                "questions": formatted_questions
+            })
+
         conn = db.get_db(prod = prod)
         cur = conn.cursor()
         # Verify that the category ID exists
@@ -295,7 +470,9 @@ def create_app(test_config = None, prod = True):
             conn.close()
             abort(404)
         # Get associated questions
-        questions = cur.execute(f"SELECT * FROM question WHERE category_id == {id}").fetchall()
+        questions = shards.select_questions(
+            f"WHERE category_id == {id}", id, prod = prod
+        )
         if len(questions) == 0:
             conn.close()
             abort(422)
@@ -326,6 +503,25 @@ def create_app(test_config = None, prod = True):
         if previous_questions is None:
             abort(400)
 
+        # Sample straight from the snapshot if there is one
+        bank = snapshot.get_snapshot(prod = prod)
+        if bank is not None:
+            category_id = None
+            if quiz_category is not None:
+                category_id = bank.category_id(quiz_category)
+                if category_id is None:
+                    abort(404)
+            try:
+                random_question = bank.sample(
+                    random, previous_questions, category_id
+                )
+            except:
+                abort(500)
+            return jsonify({
+                "success": True,
+                "question": random_question or {},
+            })
+
         conn = db.get_db(prod = prod)
         cur = conn.cursor()
 
@@ -347,7 +543,7 @@ def create_app(test_config = None, prod = True):
 
         else:
             # Otherwise, get all questions
-            raw_questions = cur.execute("SELECT * FROM question").fetchall()
+            raw_questions = shards.select_questions(prod = prod)
             questions = [format_question(i) for i in raw_questions]
 
         conn.close()
@@ -399,6 +595,28 @@ def create_app(test_config = None, prod = True):
             "message": "Unprocessable content",
         })
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": "Too many requests",
+        })
+        response.headers["Retry-After"] = str(error.retry_after)
+        return response, 429
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        # Use the real status code, so that clients and load balancers
+        # back off
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service unavailable",
+        })
+        response.headers["Retry-After"] = str(error.retry_after)
+        return response, 503
+
     @app.errorhandler(500)
     def internal_server_error(error):
         return jsonify({
@@ -0,0 +1,114 @@
+import logging
+import math
+import threading
+import time
+from flask import abort, current_app, g, request
+
+class RouteLimiter:
+    """
+    Bound the number of concurrent requests to a route. Requests beyond the
+    limit wait in a queue; once the queue is full, or a request has waited
+    longer than the deadline, it is shed rather than left to pile up.
+    """
+    def __init__(self, limit, max_queue):
+        self.semaphore = threading.BoundedSemaphore(limit)
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout):
+        """
+        Return True if the request was admitted, or False if it was shed.
+        """
+        # Take a free slot straight away if there is one
+        if self.semaphore.acquire(blocking = False):
+            return True
+        with self.lock:
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+        try:
+            return self.semaphore.acquire(timeout = timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def release(self):
+        self.semaphore.release()
+
+class TokenBucket:
+    """
+    Per-client token bucket rate limiter. Each client may make up to burst
+    requests at once, refilled at rate requests per second.
+    """
+    # Forget idle clients once we are tracking this many
+    MAX_CLIENTS = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, client):
+        """
+        Take a token for client. Return 0 if the request may go ahead, or
+        the number of seconds until a token will be available.
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self.buckets[client] = (tokens - 1, now)
+                wait = 0
+            else:
+                self.buckets[client] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            if len(self.buckets) > self.MAX_CLIENTS:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        # A bucket that would have refilled completely is the same as no bucket
+        self.buckets = {
+            client: (tokens, last)
+            for client, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * self.rate < self.burst
+        }
+
+def admit():
+    """
+    Apply rate limiting and admission control before a request is handled.
+    """
+    bucket = current_app.extensions["admission"]["bucket"]
+    if bucket is not None:
+        wait = bucket.take(request.remote_addr)
+        if wait > 0:
+            logging.warning(f"Rate limited {request.remote_addr}")
+            abort(429, retry_after = math.ceil(wait))
+
+    limiter = current_app.extensions["admission"]["limiters"].get(request.endpoint)
+    if limiter is None:
+        return
+    if not limiter.acquire(current_app.config["ADMISSION_QUEUE_TIMEOUT"]):
+        logging.warning(f"Shed request to {request.endpoint}")
+        abort(503, retry_after = current_app.config["ADMISSION_RETRY_AFTER"])
+    g.admission = limiter
+
+def release(e = None):
+    limiter = g.pop("admission", None)
+    if limiter is not None:
+        limiter.release()
+
+def init_app(app):
+    limiters = {
+        endpoint: RouteLimiter(limit, app.config["ADMISSION_MAX_QUEUE"])
+        for endpoint, limit in app.config["ADMISSION_LIMITS"].items()
+    }
+    bucket = None
+    if app.config["RATE_LIMIT"] is not None:
+        bucket = TokenBucket(*app.config["RATE_LIMIT"])
+    app.extensions["admission"] = {"limiters": limiters, "bucket": bucket}
+    app.before_request(admit)
+    app.teardown_request(release)
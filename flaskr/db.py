@@ -1,3 +1,4 @@
+import os
 import sqlite3
 import click
 from flask import current_app, g
@@ -29,9 +30,25 @@ def init_db(prod = False):
     Initialise the production or test database. Set prod = True for the 
     production database, or prod = False (the default) for the test database.
     """
+    from . import dedup, shards, snapshot
     db = get_db(prod = prod)
     with current_app.open_resource("schema.sql") as f:
         db.executescript(f.read().decode("utf8"))
+    dedup.build_index(db, db.execute("SELECT id, question FROM question"))
+    # Move the initial questions into their shards, if sharding is enabled,
+    # and remove any old shards
+    if prod:
+        db_name = current_app.config["PROD_DATABASE"]
+    else:
+        db_name = current_app.config["TEST_DATABASE"]
+    for path in shards.existing_shard_paths(db_name):
+        os.unlink(path)
+    shard_paths = shards.get_shard_paths(prod = prod)
+    if len(shard_paths) > 0:
+        shards.reshard(db, [], shard_paths)
+    # Replace the snapshot, which would otherwise keep serving the old bank
+    if current_app.config["USE_SNAPSHOT"]:
+        snapshot.build_snapshot(prod = prod)
 
 @click.command("init-test-db")
 def init_test_db_command():
@@ -0,0 +1,247 @@
+import array
+import hashlib
+import itertools
+import struct
+import click
+from flask import current_app
+
+from . import db as database, shards, suggest
+
+# Signatures are NUM_HASHES minhashes, split into BANDS bands of ROWS rows for
+# locality sensitive hashing. Two questions become candidates if all the rows
+# of any band match, which is likely once their similarity is above roughly
+# (1 / BANDS) ** (1 / ROWS) = 0.5.
+NUM_HASHES = 64
+BANDS = 16
+ROWS = NUM_HASHES // BANDS
+SHINGLE = 4
+
+def _hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size = 8).digest(), "little")
+
+def _signed(value):
+    # Fit a 64-bit hash into an SQLite INTEGER
+    return struct.unpack("<q", struct.pack("<Q", value))[0]
+
+def normalize(text):
+    """
+    Return a question's text in lower case, with runs of whitespace collapsed.
+    Punctuation is kept, since it can change the meaning (e.g., "2+2" and
+    "2-2").
+    """
+    return " ".join(text.lower().split())
+
+def text_hash(text):
+    """
+    Return a hash of a question's normalized text. Questions with the same
+    hash are exact duplicates.
+    """
+    return _signed(_hash(normalize(text).encode("utf8")))
+
+def shingles(text):
+    """
+    Return the set of character shingles of a question, ignoring case and
+    punctuation, so that questions differing only in punctuation are
+    near-duplicates.
+    """
+    text = " ".join(suggest.tokenize(text))
+    if len(text) <= SHINGLE:
+        return {text}
+    return {text[i:i + SHINGLE] for i in range(len(text) - SHINGLE + 1)}
+
+def signature(text):
+    """
+    Return the minhash signature of a question. Each shingle's NUM_HASHES
+    independent 64-bit hashes are taken from a single SHAKE digest of it.
+    """
+    hashes = []
+    for s in shingles(text):
+        h = array.array("Q")
+        h.frombytes(hashlib.shake_128(s.encode("utf8")).digest(NUM_HASHES * 8))
+        hashes.append(h)
+    return array.array("Q", map(min, zip(*hashes)))
+
+def buckets(sig):
+    """
+    Return the LSH bucket of each band of a signature, as (band, bucket)
+    pairs. Buckets are signed, to fit in an SQLite INTEGER.
+    """
+    return [
+        (band, _signed(_hash(sig[band * ROWS:(band + 1) * ROWS].tobytes())))
+        for band in range(BANDS)
+    ]
+
+def similarity(a, b):
+    """
+    Estimate the Jaccard similarity of two questions from their signatures.
+    """
+    return sum(x == y for x, y in zip(a, b)) / NUM_HASHES
+
+def _load(blob):
+    sig = array.array("Q")
+    sig.frombytes(blob)
+    return sig
+
+def _signatures(conn, ids):
+    ids = ", ".join(str(id) for id in ids)
+    return {
+        row[0]: _load(row[1]) for row in conn.execute(
+            "SELECT question_id, signature FROM question_signature "
+            f"WHERE question_id IN ({ids})"
+        )
+    }
+
+def find_duplicates(conn, text, sig, threshold):
+    """
+    Look for duplicates of a question among the questions indexed in conn.
+    Return the IDs of exact duplicates (ignoring case and whitespace), and
+    (id, similarity) pairs for the questions whose estimated similarity is at
+    least threshold. Only questions sharing an LSH bucket are compared, so
+    this doesn't scan the whole bank.
+    """
+    exact = [
+        row[0] for row in conn.execute(
+            "SELECT question_id FROM question_signature WHERE text_hash = ?",
+            (text_hash(text),)
+        )
+    ]
+    pairs = buckets(sig)
+    condition = " OR ".join(["(band = ? AND bucket = ?)"] * len(pairs))
+    candidates = [
+        row[0] for row in conn.execute(
+            f"SELECT DISTINCT question_id FROM question_band WHERE {condition}",
+            [value for pair in pairs for value in pair]
+        )
+    ]
+    near = []
+    if len(candidates) > 0:
+        for id, other in _signatures(conn, candidates).items():
+            score = similarity(sig, other)
+            if score >= threshold:
+                near.append((id, score))
+    return exact, near
+
+def _each_location(fn, prod = False):
+    """
+    Call fn with a connection to each database holding questions (and their
+    index entries): every shard, or just the main database.
+    """
+    if len(shards.get_shard_paths(prod = prod)) == 0:
+        return [fn(database.get_db(prod = prod))]
+    return shards.map_shards(fn, prod = prod)
+
+def check(text, sig, threshold, prod = False):
+    """
+    Look for duplicates of a question across the whole bank. Return the IDs
+    of exact duplicates, and (id, similarity) pairs for near-duplicates, most
+    similar first.
+    """
+    results = _each_location(
+        lambda conn: find_duplicates(conn, text, sig, threshold), prod = prod
+    )
+    exact = sorted(id for ids, near in results for id in ids)
+    near = sorted(
+        (pair for ids, near in results for pair in near),
+        key = lambda d: (-d[1], d[0])
+    )
+    return exact, near
+
+def add_question(conn, id, text, sig):
+    """
+    Index a question. This doesn't commit, so that the index entries can be
+    written in the same transaction as the question.
+    """
+    conn.execute(
+        "INSERT OR REPLACE INTO question_signature "
+        "(question_id, text_hash, signature) VALUES (?, ?, ?)",
+        (id, text_hash(text), sig.tobytes())
+    )
+    conn.executemany(
+        "INSERT INTO question_band (band, bucket, question_id) VALUES (?, ?, ?)",
+        [(band, bucket, id) for band, bucket in buckets(sig)]
+    )
+
+def remove_question(conn, id):
+    """
+    Remove a question from the index, without committing.
+    """
+    conn.execute(f"DELETE FROM question_signature WHERE question_id == {id}")
+    conn.execute(f"DELETE FROM question_band WHERE question_id == {id}")
+
+def build_index(conn, questions):
+    """
+    Replace the index in conn with one over questions, a sequence of
+    (id, text) pairs.
+    """
+    conn.execute("DELETE FROM question_signature")
+    conn.execute("DELETE FROM question_band")
+    for id, text in questions:
+        add_question(conn, id, text, signature(text))
+    conn.commit()
+
+def _index_rows(conn):
+    return (
+        conn.execute("SELECT band, bucket, question_id FROM question_band").fetchall(),
+        conn.execute("SELECT question_id, signature FROM question_signature").fetchall(),
+    )
+
+def report(conns, threshold):
+    """
+    Return (id, id, similarity) for every pair of indexed questions whose
+    estimated similarity is at least threshold, across the indexes in conns.
+    """
+    return _report([_index_rows(conn) for conn in conns], threshold)
+
+def _report(indexes, threshold):
+    groups = {}
+    sigs = {}
+    for band_rows, signature_rows in indexes:
+        for band, bucket, id in band_rows:
+            groups.setdefault((band, bucket), []).append(id)
+        for id, blob in signature_rows:
+            sigs[id] = _load(blob)
+    candidates = set()
+    for ids in groups.values():
+        candidates.update(itertools.combinations(sorted(ids), 2))
+    pairs = []
+    for a, b in sorted(candidates):
+        score = similarity(sigs[a], sigs[b])
+        if score >= threshold:
+            pairs.append((a, b, score))
+    return pairs
+
+def _rebuild(conn):
+    questions = conn.execute("SELECT id, question FROM question").fetchall()
+    build_index(conn, questions)
+    return len(questions)
+
+@click.command("build-dedup-index")
+@click.option("--prod", is_flag = True, help = "Use the production database.")
+def build_dedup_index_command(prod):
+    """
+    Rebuild the near-duplicate index over every question.
+    """
+    counts = _each_location(_rebuild, prod = prod)
+    click.echo(f"Indexed {sum(counts)} questions.")
+
+@click.command("dedup-report")
+@click.option("--prod", is_flag = True, help = "Use the production database.")
+@click.option(
+    "--threshold", type = float, default = None,
+    help = "Minimum estimated similarity (default DEDUP_THRESHOLD)."
+)
+def dedup_report_command(prod, threshold):
+    """
+    List every pair of near-duplicate questions in the bank.
+    """
+    if threshold is None:
+        threshold = current_app.config["DEDUP_THRESHOLD"]
+    pairs = _report(_each_location(_index_rows, prod = prod), threshold)
+    text = {q[0]: q[2] for q in shards.select_questions(prod = prod)}
+    for a, b, score in pairs:
+        click.echo(f"{a}\t{b}\t{score:.2f}\t{text.get(a)}\t{text.get(b)}")
+    click.echo(f"Found {len(pairs)} near-duplicate pairs.")
+
+def init_app(app):
+    app.cli.add_command(build_dedup_index_command)
+    app.cli.add_command(dedup_report_command)
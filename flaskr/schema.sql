@@ -1,5 +1,8 @@
 DROP TABLE IF EXISTS category;
 DROP TABLE IF EXISTS question;
+DROP TABLE IF EXISTS question_id;
+DROP TABLE IF EXISTS question_signature;
+DROP TABLE IF EXISTS question_band;
 
 CREATE TABLE category (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -15,6 +18,25 @@ CREATE TABLE question (
     FOREIGN KEY (category_id) REFERENCES category (id)
 );
 
+-- Near-duplicate index: a hash of the normalized text and a minhash
+-- signature per question, and the locality sensitive hashing bucket of each
+-- band of the signature
+CREATE TABLE question_signature (
+    question_id INTEGER PRIMARY KEY,
+    text_hash INTEGER NOT NULL,
+    signature BLOB NOT NULL
+);
+
+CREATE INDEX question_signature_text_hash ON question_signature (text_hash);
+
+CREATE TABLE question_band (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    question_id INTEGER NOT NULL
+);
+
+CREATE INDEX question_band_bucket ON question_band (band, bucket);
+
 INSERT INTO category (type)
 VALUES
     ("Science"),
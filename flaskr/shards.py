@@ -0,0 +1,336 @@
+import fcntl
+import glob
+import heapq
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app, g
+
+from . import db as database
+
+# Shards hold questions and their near-duplicate index entries, so that both
+# are written in one transaction. Categories, and the sequence that question
+# IDs are allocated from, stay in the main database.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS question (
+    id INTEGER PRIMARY KEY,
+    category_id INTEGER NOT NULL,
+    question TEXT UNIQUE NOT NULL,
+    answer TEXT NOT NULL,
+    difficulty INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS question_signature (
+    question_id INTEGER PRIMARY KEY,
+    text_hash INTEGER NOT NULL,
+    signature BLOB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS question_signature_text_hash
+    ON question_signature (text_hash);
+
+CREATE TABLE IF NOT EXISTS question_band (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    question_id INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS question_band_bucket
+    ON question_band (band, bucket);
+"""
+
+INSERT_QUESTION = (
+    "INSERT INTO question (id, category_id, question, answer, difficulty) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+
+_pool = None
+_lock = threading.Lock()
+
+# Blocks of question IDs leased by this process, keyed by database path, as
+# [next ID, last ID]
+_leases = {}
+_lease_lock = threading.Lock()
+
+# Lock files held shared by every running app, keyed by database path, so
+# that the reshard command can tell whether the app is stopped
+_app_locks = {}
+
+def shard_paths(database_path, count):
+    """
+    Return the paths of the count shards belonging to a database.
+    """
+    root, ext = os.path.splitext(database_path)
+    return [f"{root}-shard{i}{ext}" for i in range(count)]
+
+def existing_shard_paths(database_path):
+    """
+    Return the paths of the shard files on disk for a database, which may
+    differ from the configured shards until the app is restarted.
+    """
+    root, ext = os.path.splitext(database_path)
+    pattern = re.compile(re.escape(root) + r"-shard(\d+)" + re.escape(ext) + "$")
+    matches = [
+        pattern.match(path)
+        for path in glob.glob(f"{glob.escape(root)}-shard*{ext}")
+    ]
+    matches = sorted(filter(None, matches), key = lambda m: int(m.group(1)))
+    return [m.string for m in matches]
+
+def get_shard_paths(prod = False):
+    """
+    Return the shard paths for the production or test database, or an empty
+    list if the questions are not sharded.
+    """
+    if prod:
+        database_path = current_app.config["PROD_DATABASE"]
+    else:
+        database_path = current_app.config["TEST_DATABASE"]
+    return shard_paths(database_path, current_app.config["SHARD_COUNT"])
+
+def shard_for(category_id, count):
+    """
+    Return the index of the shard that holds a category's questions.
+    """
+    return int(category_id) % count
+
+def connect(path):
+    conn = sqlite3.connect(path, detect_types = sqlite3.PARSE_DECLTYPES)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def get_shard(category_id, prod = False):
+    """
+    Return a connection to the database holding a category's questions. This
+    is the main database if the questions are not sharded.
+    """
+    paths = get_shard_paths(prod = prod)
+    if len(paths) == 0:
+        return database.get_db(prod = prod)
+    path = paths[shard_for(category_id, len(paths))]
+    if "shards" not in g:
+        g.shards = {}
+    if path not in g.shards:
+        g.shards[path] = connect(path)
+    return g.shards[path]
+
+def close_shards(e = None):
+    for conn in g.pop("shards", {}).values():
+        conn.close()
+
+def _get_pool():
+    # Created on first use, so that each worker process starts its own threads
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers = current_app.config["SHARD_THREADS"]
+            )
+    return _pool
+
+def _query(path, query):
+    conn = connect(path)
+    try:
+        return conn.execute(query).fetchall()
+    finally:
+        conn.close()
+
+def scatter(paths, query, pool = None):
+    """
+    Run a query against every shard, and merge the results by question ID.
+    The query must return rows ordered by ID. Shards are queried in parallel
+    on pool if one is given, and one after another otherwise.
+    """
+    if pool is None:
+        results = [_query(path, query) for path in paths]
+    else:
+        results = pool.map(lambda path: _query(path, query), paths)
+    return list(heapq.merge(*results, key = lambda row: row[0]))
+
+def map_shards(fn, prod = False):
+    """
+    Call fn with a connection to every shard in parallel, and return the
+    results in shard order.
+    """
+    def call(path):
+        conn = connect(path)
+        try:
+            return fn(conn)
+        finally:
+            conn.close()
+    return list(_get_pool().map(call, get_shard_paths(prod = prod)))
+
+def select_questions(where = "", category_id = None, prod = False):
+    """
+    Return the questions matching a WHERE clause, in ID order. If the query
+    only concerns one category, pass its category_id so that only one shard
+    is queried.
+    """
+    query = f"SELECT * FROM question {where} ORDER BY id"
+    paths = get_shard_paths(prod = prod)
+    if len(paths) == 0 or category_id is not None:
+        return get_shard(category_id, prod = prod).execute(query).fetchall()
+    return scatter(paths, query, pool = _get_pool())
+
+def _lease_ids(conn, size):
+    """
+    Reserve the next size IDs from the sequence in the main database, and
+    return them as [first ID, last ID].
+    """
+    cur = conn.cursor()
+    cur.execute("INSERT INTO question_id DEFAULT VALUES")
+    first = cur.lastrowid
+    cur.execute(f"DELETE FROM question_id WHERE id == {first}")
+    cur.execute(
+        f"UPDATE sqlite_sequence SET seq = {first + size - 1} "
+        "WHERE name = 'question_id'"
+    )
+    conn.commit()
+    return [first, first + size - 1]
+
+def allocate_id(prod = False):
+    """
+    Allocate a question ID that is unique across shards. Each process leases
+    IDs from the main database in blocks of SHARD_ID_BLOCK, so only one
+    insert per block writes to the main database.
+    """
+    if prod:
+        database_path = current_app.config["PROD_DATABASE"]
+    else:
+        database_path = current_app.config["TEST_DATABASE"]
+    with _lease_lock:
+        lease = _leases.get(database_path)
+        if lease is None or lease[0] > lease[1]:
+            lease = _lease_ids(
+                database.get_db(prod = prod),
+                current_app.config["SHARD_ID_BLOCK"]
+            )
+            _leases[database_path] = lease
+        id = lease[0]
+        lease[0] += 1
+    return id
+
+def _app_lock_path(database_path):
+    return database_path + ".lock"
+
+def hold_app_lock(database_path):
+    """
+    Hold a shared lock on a database for the life of this process, marking
+    the app as running. Waits while the database is being resharded.
+    """
+    with _lock:
+        if database_path in _app_locks:
+            return
+        try:
+            f = open(_app_lock_path(database_path), "a")
+        except OSError:
+            # The database's directory doesn't exist, so neither does it
+            return
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        _app_locks[database_path] = f
+
+def release_app_lock(database_path):
+    with _lock:
+        f = _app_locks.pop(database_path, None)
+    if f is not None:
+        f.close()
+
+def reshard(conn, source_paths, target_paths):
+    """
+    Move every question from the source shards to the target shards. An empty
+    list of paths means the question table in the main database. The new
+    shards are written in full before they replace the old ones. The
+    near-duplicate index is rebuilt alongside the questions.
+    """
+    from . import dedup
+    if len(source_paths) == 0:
+        questions = conn.execute("SELECT * FROM question ORDER BY id").fetchall()
+    else:
+        with ThreadPoolExecutor(max_workers = len(source_paths)) as pool:
+            questions = scatter(
+                source_paths, "SELECT * FROM question ORDER BY id", pool = pool
+            )
+
+    if len(target_paths) == 0:
+        conn.execute("DELETE FROM question")
+        conn.executemany(INSERT_QUESTION, [tuple(q) for q in questions])
+        dedup.build_index(conn, [(q[0], q[2]) for q in questions])
+    else:
+        tmp_paths = [path + ".tmp" for path in target_paths]
+        for i, tmp_path in enumerate(tmp_paths):
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            shard = sqlite3.connect(tmp_path)
+            shard.executescript(SCHEMA)
+            shard_questions = [
+                tuple(q) for q in questions
+                if shard_for(q[1], len(target_paths)) == i
+            ]
+            shard.executemany(INSERT_QUESTION, shard_questions)
+            dedup.build_index(shard, [(q[0], q[2]) for q in shard_questions])
+            shard.close()
+        for tmp_path, path in zip(tmp_paths, target_paths):
+            os.replace(tmp_path, path)
+        conn.execute("DELETE FROM question")
+        conn.execute("DELETE FROM question_signature")
+        conn.execute("DELETE FROM question_band")
+
+    for path in source_paths:
+        if path not in target_paths and os.path.exists(path):
+            os.unlink(path)
+
+    # Make sure new IDs are allocated after every existing question
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS question_id "
+        "(id INTEGER PRIMARY KEY AUTOINCREMENT)"
+    )
+    if len(questions) > 0:
+        last_id = max(q[0] for q in questions)
+        conn.execute(f"INSERT OR IGNORE INTO question_id (id) VALUES ({last_id})")
+        conn.execute(f"DELETE FROM question_id WHERE id == {last_id}")
+    conn.commit()
+    # Start new leases from the sequence. (Other processes must be restarted
+    # after resharding anyway.)
+    with _lease_lock:
+        _leases.clear()
+
+@click.command("reshard")
+@click.argument("count", type = int)
+@click.option("--prod", is_flag = True, help = "Use the production database.")
+def reshard_command(count, prod):
+    """
+    Move the questions into COUNT shards (0 to unshard them). The app must
+    be stopped first: running workers would keep routing to the old shards,
+    and lose writes. Set SHARD_COUNT to COUNT before starting it again.
+    """
+    if prod:
+        database_path = current_app.config["PROD_DATABASE"]
+    else:
+        database_path = current_app.config["TEST_DATABASE"]
+    # Every running app holds the lock shared, so only take it exclusively
+    # once this process has let go of its own
+    release_app_lock(database_path)
+    with open(_app_lock_path(database_path), "a") as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise click.ClickException(
+                "The app is running. Stop it before resharding."
+            )
+        reshard(
+            database.get_db(prod = prod),
+            existing_shard_paths(database_path),
+            shard_paths(database_path, count),
+        )
+    click.echo(f"Resharded the questions into {count} shards.")
+
+def init_app(app):
+    app.teardown_appcontext(close_shards)
+    app.cli.add_command(reshard_command)
+    # Mark the app as running for as long as this process lives (and any
+    # workers forked from it)
+    hold_app_lock(app.config["PROD_DATABASE"])
+    hold_app_lock(app.config["TEST_DATABASE"])
@@ -0,0 +1,420 @@
+import array
+import bisect
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import click
+from flask import current_app
+
+from . import db as database, shards
+
+# File layout: a fixed header, followed by a series of int64 columns and a
+# single UTF-8 string pool. Every column is 8-byte aligned, so each one can be
+# cast straight from the memory map without copying.
+MAGIC = b"FLKSNAP1"
+HEADER = struct.Struct("<8sqqq")
+ITEM = array.array("q").itemsize
+
+# Open snapshots and background rebuilders for this process, keyed by path
+_snapshots = {}
+_rebuilders = {}
+_lock = threading.Lock()
+
+# The lock file next to a snapshot records when the last rebuild started
+# reading the bank, in nanoseconds since the epoch
+STAMP = struct.Struct("<q")
+
+class Snapshot:
+    """
+    A read-only, memory-mapped view of the question bank. Questions are stored
+    in id order, so lookups by id are a binary search over the id column.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+        magic, n_questions, n_categories, pool_size = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a question bank snapshot")
+
+        # Slice each column out of the buffer in the order it was written
+        offset = HEADER.size
+        columns = []
+        for length in (
+            n_questions,        # ids
+            n_questions,        # category_ids
+            n_questions,        # difficulties
+            n_questions + 1,    # question text offsets
+            n_questions + 1,    # answer text offsets
+            n_categories,       # category ids
+            n_categories + 1,   # category type offsets
+            n_categories + 1,   # per-category index offsets
+            None,               # per-category index (row numbers)
+        ):
+            if length is None:
+                # The index only covers questions in a known category
+                length = columns[-1][-1]
+            end = offset + length * ITEM
+            columns.append(buf[offset:end].cast("q"))
+            offset = end
+        (
+            self.ids,
+            self.category_ids,
+            self.difficulties,
+            self._question_offsets,
+            self._answer_offsets,
+            self._category_ids,
+            self._category_offsets,
+            self._index_offsets,
+            self._index,
+        ) = columns
+        self._pool = buf[offset:offset + pool_size]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _text(self, offsets, i):
+        return str(self._pool[offsets[i]:offsets[i + 1]], "utf8")
+
+    def _row(self, row):
+        return {
+            "id": self.ids[row],
+            "category_id": self.category_ids[row],
+            "question": self._text(self._question_offsets, row),
+            "answer": self._text(self._answer_offsets, row),
+            "difficulty": self.difficulties[row],
+        }
+
+    def get_question(self, id):
+        """
+        Return a formatted question, or None if there is no question at id.
+        """
+        row = bisect.bisect_left(self.ids, id)
+        if row == len(self.ids) or self.ids[row] != id:
+            return None
+        return self._row(row)
+
+    def categories(self):
+        """
+        Return a list of (id, type) tuples for every category.
+        """
+        return [
+            (self._category_ids[i], self._text(self._category_offsets, i))
+            for i in range(len(self._category_ids))
+        ]
+
+    def category_id(self, type):
+        """
+        Return the ID of the category matching type (case insensitive),
+        or None if there is no such category.
+        """
+        if not isinstance(type, str):
+            return None
+        type = type.lower()
+        for id, name in self.categories():
+            if name.lower() == type:
+                return id
+        return None
+
+    def category(self, category_id):
+        """
+        Return the type of a category, or None if there is no such category.
+        """
+        i = bisect.bisect_left(self._category_ids, category_id)
+        if i == len(self._category_ids) or self._category_ids[i] != category_id:
+            return None
+        return self._text(self._category_offsets, i)
+
+    def questions_in_category(self, category_id):
+        """
+        Return the formatted questions in a category, in ID order.
+        """
+        return [self._row(row) for row in self.rows_in_category(category_id)]
+
+    def rows_in_category(self, category_id):
+        """
+        Return the row numbers of the questions in a category.
+        """
+        i = bisect.bisect_left(self._category_ids, category_id)
+        if i == len(self._category_ids) or self._category_ids[i] != category_id:
+            return self._index[0:0]
+        return self._index[self._index_offsets[i]:self._index_offsets[i + 1]]
+
+    def sample(self, rng, previous_questions, category_id = None):
+        """
+        Return a random formatted question whose ID is not in
+        previous_questions, or None if there are none left.
+        """
+        if category_id is None:
+            rows = range(len(self.ids))
+        else:
+            rows = self.rows_in_category(category_id)
+        previous_questions = set(previous_questions)
+        unasked = [row for row in rows if self.ids[row] not in previous_questions]
+        if len(unasked) == 0:
+            return None
+        return self._row(rng.choice(unasked))
+
+def _pool_column(strings, pool):
+    """
+    Append strings to pool, and return an array of their offsets into it.
+    """
+    offsets = array.array("q", [len(pool)])
+    for s in strings:
+        pool.extend(s.encode("utf8"))
+        offsets.append(len(pool))
+    return offsets
+
+@contextlib.contextmanager
+def _rebuild_lock(path):
+    """
+    Hold an exclusive lock on a file next to path, and yield the file. flock
+    locks belong to the open file, so this serializes rebuilds across threads
+    as well as across worker processes.
+    """
+    with open(path + ".lock", "a+b") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def write_snapshot(conn, path, load_questions = None, since = None):
+    """
+    Write a snapshot of the question bank in conn to path. The file is
+    written next to path and renamed over it, so readers never see a
+    partially written snapshot. Pass load_questions, a function returning the
+    questions in ID order, if they are not stored in conn, e.g., because they
+    are sharded.
+
+    Rebuilds are serialized, and read the bank while holding the lock, so a
+    rebuild that read older data can never replace a newer snapshot. If since
+    (a time.time_ns() timestamp) is given, the rebuild is skipped when another
+    one started reading the bank after it, as that one already saw every
+    write made before since. Return whether the snapshot was written.
+    """
+    with _rebuild_lock(path) as f:
+        f.seek(0)
+        stamp = f.read(STAMP.size)
+        if since is not None and len(stamp) == STAMP.size:
+            if STAMP.unpack(stamp)[0] >= since:
+                return False
+        started = time.time_ns()
+        _write_snapshot(conn, path, load_questions)
+        f.seek(0)
+        f.truncate()
+        f.write(STAMP.pack(started))
+        f.flush()
+    return True
+
+def _write_snapshot(conn, path, load_questions):
+    cur = conn.cursor()
+    if load_questions is None:
+        questions = cur.execute(
+            "SELECT id, category_id, question, answer, difficulty "
+            "FROM question ORDER BY id"
+        ).fetchall()
+    else:
+        questions = load_questions()
+    categories = cur.execute(
+        "SELECT id, type FROM category ORDER BY id"
+    ).fetchall()
+
+    pool = bytearray()
+    question_offsets = _pool_column((q[2] for q in questions), pool)
+    answer_offsets = _pool_column((q[3] for q in questions), pool)
+    category_offsets = _pool_column((c[1] for c in categories), pool)
+
+    # Group row numbers by category, in category id order
+    rows_by_category = {c[0]: array.array("q") for c in categories}
+    for row, question in enumerate(questions):
+        if question[1] in rows_by_category:
+            rows_by_category[question[1]].append(row)
+    index = array.array("q")
+    index_offsets = array.array("q", [0])
+    for category in categories:
+        index.extend(rows_by_category[category[0]])
+        index_offsets.append(len(index))
+
+    columns = (
+        array.array("q", (q[0] for q in questions)),
+        array.array("q", (q[1] for q in questions)),
+        array.array("q", (q[4] for q in questions)),
+        question_offsets,
+        answer_offsets,
+        array.array("q", (c[0] for c in categories)),
+        category_offsets,
+        index_offsets,
+        index,
+    )
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir = directory, suffix = ".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(questions), len(categories), len(pool)))
+            for column in columns:
+                column.tofile(f)
+            f.write(pool)
+            f.flush()
+            os.fsync(f.fileno())
+            # mkstemp creates the file readable by its owner only, but every
+            # worker must be able to map it
+            os.fchmod(f.fileno(), 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def snapshot_path(prod = False):
+    if prod:
+        return current_app.config["PROD_SNAPSHOT"]
+    return current_app.config["TEST_SNAPSHOT"]
+
+def get_snapshot(prod = False):
+    """
+    Return the snapshot for the production or test database, or None if
+    snapshots are disabled or the snapshot has not been built. The snapshot is
+    reopened whenever the file on disk has been replaced.
+    """
+    if not current_app.config["USE_SNAPSHOT"]:
+        return None
+    path = snapshot_path(prod = prod)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    with _lock:
+        snapshot = _snapshots.get(path)
+        if snapshot is None or (
+            (snapshot.stat.st_ino, snapshot.stat.st_mtime_ns)
+            != (stat.st_ino, stat.st_mtime_ns)
+        ):
+            # Leave any old mapping to the garbage collector, since another
+            # thread may still be reading from it
+            snapshot = Snapshot(path)
+            _snapshots[path] = snapshot
+    return snapshot
+
+def build_snapshot(prod = False):
+    """
+    Write a snapshot of the production or test database, wherever its
+    questions are stored.
+    """
+    write_snapshot(
+        database.get_db(prod = prod),
+        snapshot_path(prod = prod),
+        load_questions = lambda: shards.select_questions(prod = prod),
+    )
+
+class Rebuilder:
+    """
+    Regenerate a snapshot on a background thread after writes, so that
+    requests never wait for a rebuild. Writes that arrive while a rebuild is
+    running are coalesced into a single rebuild after it, and a rebuild is
+    skipped altogether if another worker's rebuild has already covered them.
+    """
+    def __init__(self, database, shard_paths, path):
+        self.database = database
+        self.shard_paths = shard_paths
+        self.path = path
+        self.pid = os.getpid()
+        # Time of the latest write not yet picked up by a rebuild
+        self.requested = None
+        self.running = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def mark_stale(self):
+        """
+        Note that the bank has changed, and wake the rebuilder.
+        """
+        with self.condition:
+            self.requested = time.time_ns()
+            self.condition.notify_all()
+
+    def wait(self, timeout = None):
+        """
+        Wait until every write marked so far is in the snapshot. Return False
+        if that took longer than timeout seconds.
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.requested is None and not self.running, timeout
+            )
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.requested is not None)
+                since, self.requested = self.requested, None
+                self.running = True
+            try:
+                self._rebuild(since)
+            except:
+                # The next write will try again
+                logging.exception("Snapshot could not be rebuilt.")
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def _rebuild(self, since):
+        conn = sqlite3.connect(self.database)
+        try:
+            load_questions = None
+            if len(self.shard_paths) > 0:
+                load_questions = lambda: shards.scatter(
+                    self.shard_paths, "SELECT * FROM question ORDER BY id"
+                )
+            write_snapshot(conn, self.path, load_questions, since = since)
+        finally:
+            conn.close()
+
+def get_rebuilder(prod = False):
+    """
+    Return the background rebuilder for the production or test snapshot,
+    starting it on first use in each worker process.
+    """
+    if prod:
+        database_path = current_app.config["PROD_DATABASE"]
+    else:
+        database_path = current_app.config["TEST_DATABASE"]
+    path = snapshot_path(prod = prod)
+    with _lock:
+        rebuilder = _rebuilders.get(path)
+        # Threads don't survive a fork, so each worker needs its own
+        if rebuilder is None or rebuilder.pid != os.getpid():
+            rebuilder = _rebuilders[path] = Rebuilder(
+                database_path, shards.get_shard_paths(prod = prod), path
+            )
+    return rebuilder
+
+def refresh_snapshot(prod = False):
+    """
+    Mark the snapshot stale after a write, if snapshots are enabled. It is
+    regenerated in the background, so reads may briefly miss the write.
+    """
+    if current_app.config["USE_SNAPSHOT"]:
+        get_rebuilder(prod = prod).mark_stale()
+
+@click.command("build-snapshot")
+@click.option("--prod", is_flag = True, help = "Use the production database.")
+def build_snapshot_command(prod):
+    """
+    Write a memory-mapped snapshot of the question bank.
+    """
+    build_snapshot(prod = prod)
+    click.echo("Built the question bank snapshot.")
+
+def init_app(app):
+    app.cli.add_command(build_snapshot_command)
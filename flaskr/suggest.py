@@ -0,0 +1,180 @@
+import bisect
+import logging
+import re
+import sys
+import threading
+import time
+from flask import current_app
+
+from . import shards
+
+TOKEN = re.compile(r"\w+")
+
+# Sorts after every token starting with a given prefix
+_END = chr(sys.maxunicode)
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+class TokenIndex:
+    """
+    An in-memory prefix index over question text. Every (token, id) pair is
+    kept in one sorted list, so the questions with a token starting with a
+    prefix are a contiguous range found by binary search.
+    """
+    def __init__(self, questions = ()):
+        self.text = {}
+        self.entries = []
+        self.lock = threading.Lock()
+        for id, text in questions:
+            self.text[id] = text
+            self.entries.extend((token, id) for token in set(tokenize(text)))
+        self.entries.sort()
+        self.built = time.monotonic()
+        # Updates made while a replacement index is being built, to be
+        # replayed onto it. None when no rebuild is running.
+        self.log = None
+
+    def add(self, id, text):
+        with self.lock:
+            self._remove(id)
+            self.text[id] = text
+            for token in set(tokenize(text)):
+                bisect.insort(self.entries, (token, id))
+
+    def remove(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        text = self.text.pop(id, None)
+        if text is None:
+            return
+        for token in set(tokenize(text)):
+            i = bisect.bisect_left(self.entries, (token, id))
+            if i < len(self.entries) and self.entries[i] == (token, id):
+                del self.entries[i]
+
+    def _range(self, prefix):
+        """
+        Return the start and end of the entries with a token starting with
+        prefix.
+        """
+        return (
+            bisect.bisect_left(self.entries, (prefix,)),
+            bisect.bisect_left(self.entries, (prefix + _END,)),
+        )
+
+    def suggest(self, prefix, limit):
+        """
+        Return up to limit (id, text) pairs for the questions with a token
+        starting with each word of prefix, in ID order. Only the entries for
+        the rarest word are scanned, and the scan stops once limit questions
+        have been found, so the matches returned are the first ones in token
+        order rather than the lowest IDs.
+        """
+        tokens = set(tokenize(prefix))
+        if len(tokens) == 0:
+            return []
+        with self.lock:
+            ranges = {token: self._range(token) for token in tokens}
+            rarest = min(tokens, key = lambda t: ranges[t][1] - ranges[t][0])
+            others = tokens - {rarest}
+            ids = set()
+            rejected = set()
+            for i in range(*ranges[rarest]):
+                id = self.entries[i][1]
+                if id in ids or id in rejected:
+                    continue
+                # Check the other words against the question's own tokens
+                if len(others) > 0:
+                    words = set(tokenize(self.text[id]))
+                    if not all(
+                        any(word.startswith(token) for word in words)
+                        for token in others
+                    ):
+                        rejected.add(id)
+                        continue
+                ids.add(id)
+                if len(ids) == limit:
+                    break
+            return [(id, self.text[id]) for id in sorted(ids)]
+
+# Guards building, swapping and updating the indexes
+_lock = threading.Lock()
+
+def _build(prod):
+    return TokenIndex(
+        (q[0], q[2]) for q in shards.select_questions(prod = prod)
+    )
+
+def _rebuild(app, prod, old):
+    """
+    Build a replacement for the old index in the background, replay the
+    updates made to the old index in the meantime, and swap it in.
+    """
+    try:
+        with app.app_context():
+            new = _build(prod)
+        with _lock:
+            for op, args in old.log:
+                getattr(new, op)(*args)
+            app.extensions["suggest"][prod] = new
+    except:
+        logging.exception("Suggestion index could not be rebuilt.")
+        # Keep serving the old index, and try again after SUGGEST_REFRESH
+        with _lock:
+            old.built = time.monotonic()
+            old.log = None
+
+def get_index(prod = False):
+    """
+    Return the prefix index for the production or test database, building it
+    on first use. Each worker keeps its own index up to date with its own
+    writes. To pick up writes from other workers, the index is rebuilt in the
+    background every SUGGEST_REFRESH seconds, while requests keep using the
+    current one.
+    """
+    indexes = current_app.extensions.setdefault("suggest", {})
+    index = indexes.get(prod)
+    if index is None:
+        with _lock:
+            index = indexes.get(prod)
+            if index is None:
+                index = indexes[prod] = _build(prod)
+        return index
+
+    if time.monotonic() - index.built > current_app.config["SUGGEST_REFRESH"]:
+        with _lock:
+            # Only the first request to see the stale index starts a rebuild
+            start = index.log is None and indexes.get(prod) is index
+            if start:
+                index.log = []
+        if start:
+            threading.Thread(
+                target = _rebuild,
+                args = (current_app._get_current_object(), prod, index),
+                daemon = True,
+            ).start()
+    return index
+
+def _update(prod, op, *args):
+    with _lock:
+        index = current_app.extensions.get("suggest", {}).get(prod)
+        if index is None:
+            return
+        getattr(index, op)(*args)
+        if index.log is not None:
+            index.log.append((op, args))
+
+def add_question(id, text, prod = False):
+    """
+    Add a new question to the index, if it has been built.
+    """
+    _update(prod, "add", id, text)
+
+def remove_question(id, prod = False):
+    """
+    Remove a deleted question from the index, if it has been built.
+    """
+    _update(prod, "remove", id)
@@ -0,0 +1,161 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from flask import current_app
+
+from . import dedup, shards, snapshot
+
+INSERT_QUESTION = (
+    "INSERT INTO question (category_id, question, answer, difficulty) "
+    "VALUES (?, ?, ?, ?)"
+)
+
+class BatchWriter:
+    """
+    Queue question inserts from many requests onto a single writer thread,
+    which commits them in groups. A group is committed once batch_size
+    inserts are waiting, or window seconds after the first one arrived,
+    so the cost of each commit (and its fsync) is shared by the group.
+    """
+    def __init__(
+        self, database, batch_size, window, on_commit = None,
+        insert = INSERT_QUESTION
+    ):
+        self.database = database
+        self.insert = insert
+        self.batch_size = batch_size
+        self.window = window
+        self.on_commit = on_commit
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def submit(self, *values, dedup_entry = None):
+        """
+        Queue a question's values for insertion. Return a Future that resolves
+        to the new question's ID once its group has been committed, or raises
+        the sqlite3.Error that prevented it from being inserted. If given,
+        dedup_entry is the question's (text, signature), which is added to
+        the near-duplicate index in the same transaction.
+        """
+        future = Future()
+        self.queue.put((future, values, dedup_entry))
+        return future
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout = remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = None
+        while True:
+            batch = self._next_batch()
+            try:
+                if conn is None:
+                    # Manage transactions explicitly, rather than letting the
+                    # sqlite3 module open them implicitly
+                    conn = sqlite3.connect(self.database, isolation_level = None)
+                self._commit(conn, batch)
+            except Exception as e:
+                # Never let the thread die, or every waiting request would
+                # hang. Fail this group, and reconnect for the next one.
+                logging.exception("Question batch failed.")
+                for future, values, dedup_entry in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except sqlite3.Error:
+                        pass
+                    conn = None
+
+    def _commit(self, conn, batch):
+        cur = conn.cursor()
+        results = []
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            for future, values, dedup_entry in batch:
+                # A savepoint per insert means that one bad question
+                # (e.g., a duplicate) doesn't fail the rest of the group
+                cur.execute("SAVEPOINT question")
+                try:
+                    cur.execute(self.insert, values)
+                    id = cur.lastrowid
+                    if dedup_entry is not None:
+                        dedup.add_question(conn, id, *dedup_entry)
+                    results.append(id)
+                    cur.execute("RELEASE question")
+                except sqlite3.Error as e:
+                    cur.execute("ROLLBACK TO question")
+                    cur.execute("RELEASE question")
+                    results.append(e)
+            cur.execute("COMMIT")
+            committed = True
+        except sqlite3.Error as e:
+            logging.warning("Question batch could not be committed.")
+            committed = False
+            results = [e] * len(batch)
+            if conn.in_transaction:
+                cur.execute("ROLLBACK")
+
+        if committed and self.on_commit is not None:
+            try:
+                self.on_commit(conn)
+            except:
+                logging.exception("Post-commit hook failed.")
+
+        for (future, values, dedup_entry), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+_lock = threading.Lock()
+
+def get_writer(category_id = None, prod = False):
+    """
+    Return the batch writer for the production or test database, starting it
+    on first use. It is started lazily so that each worker process gets its
+    own writer thread after forking. If the questions are sharded, each shard
+    has its own writer, and questions must be submitted with their ID.
+    """
+    writers = current_app.extensions.setdefault("writers", {})
+    if prod:
+        database = current_app.config["PROD_DATABASE"]
+    else:
+        database = current_app.config["TEST_DATABASE"]
+    shard_paths = shards.get_shard_paths(prod = prod)
+    if len(shard_paths) == 0:
+        path, insert = database, INSERT_QUESTION
+    else:
+        path = shard_paths[shards.shard_for(category_id, len(shard_paths))]
+        insert = shards.INSERT_QUESTION
+    with _lock:
+        if path not in writers:
+            on_commit = None
+            if current_app.config["USE_SNAPSHOT"]:
+                # Only mark the snapshot stale, so the group's requests
+                # don't wait for it to be rebuilt
+                rebuilder = snapshot.get_rebuilder(prod = prod)
+                on_commit = lambda conn: rebuilder.mark_stale()
+            writers[path] = BatchWriter(
+                path,
+                current_app.config["WRITE_BATCH_SIZE"],
+                current_app.config["WRITE_BATCH_WINDOW"],
+                on_commit = on_commit,
+                insert = insert,
+            )
+    return writers[path]
@@ -1,6 +1,11 @@
 import unittest
-from flaskr import create_app, db
+from flaskr import create_app, admission, db, dedup, shards, snapshot, writer
+import fcntl
 import json
+import os
+import sqlite3
+import tempfile
+import time
 
 class QuestionsTestCase(unittest.TestCase):
     def setUp(self):
@@ -110,6 +115,100 @@ class QuestionsTestCase(unittest.TestCase):
         self.assertEqual(data["number_of_questions"], 1)
         self.assertEqual(len(data["questions"]), 1)
 
+    def test_suggest_questions(self):
+        """
+        Test GET /questions/suggest with a prefix. E.g.,
+        GET /questions/suggest?prefix=tit
+        """
+        res = self.client().get("/questions/suggest?prefix=tit")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        # Test data has one question with a word starting with "tit"
+        self.assertEqual(len(data["suggestions"]), 1)
+        # ...and 18 with a word starting with "wh"
+        res = self.client().get("/questions/suggest?prefix=wh")
+        data = json.loads(res.data)
+        self.assertEqual(len(data["suggestions"]), 10)
+        res = self.client().get("/questions/suggest?prefix=wh&limit=3")
+        data = json.loads(res.data)
+        self.assertEqual(len(data["suggestions"]), 3)
+        res = self.client().get("/questions/suggest?prefix=the%20heav")
+        data = json.loads(res.data)
+        self.assertEqual(data["suggestions"], [{
+            "id": 1,
+            "question": "What is the heaviest organ in the human body?"
+        }])
+
+    def test_suggest_questions_400(self):
+        """
+        Test GET /questions/suggest without a prefix returns 400
+        """
+        res = self.client().get("/questions/suggest")
+        data = json.loads(res.data)
+        self.assertFalse(data["success"])
+        self.assertEqual(data["error"], 400)
+
+    def test_suggest_questions_after_writes(self):
+        """
+        Test that the suggestion index follows created and deleted questions
+        """
+        self.client().get("/questions/suggest?prefix=ruby")
+        res = self.client().post("/questions", json = {
+            "question": "How many years are celebrated with a ruby anniversary?",
+            "answer": "40",
+            "category_id": 4,
+            "difficulty": 3
+        })
+        created_id = json.loads(res.data)["created_id"]
+        res = self.client().get("/questions/suggest?prefix=ruby")
+        data = json.loads(res.data)
+        self.assertEqual(data["suggestions"][0]["id"], created_id)
+        self.client().delete(f"/questions/{created_id}")
+        res = self.client().get("/questions/suggest?prefix=ruby")
+        data = json.loads(res.data)
+        self.assertEqual(data["suggestions"], [])
+
+    def test_create_non_string_question_after_suggest(self):
+        """
+        Test that a question that isn't a string is still created once the
+        suggestion index has been built
+        """
+        self.client().get("/questions/suggest?prefix=wh")
+        res = self.client().post("/questions", json = {
+            "question": 1234,
+            "answer": "40",
+            "category_id": 4,
+            "difficulty": 3
+        })
+        created_id = json.loads(res.data)["created_id"]
+        res = self.client().get("/questions/suggest?prefix=123")
+        data = json.loads(res.data)
+        self.assertEqual(data["suggestions"], [
+            {"id": created_id, "question": "1234"}
+        ])
+
+    def test_suggest_index_rebuilt_in_background(self):
+        """
+        Test that a stale suggestion index keeps serving requests while it
+        is rebuilt, and picks up questions written by other workers
+        """
+        self.app.config["SUGGEST_REFRESH"] = 0
+        self.client().get("/questions/suggest?prefix=ruby")
+        with self.app.app_context():
+            conn = db.get_db()
+            conn.execute(
+                "INSERT INTO question (category_id, question, answer, difficulty) "
+                "VALUES (4, 'What is a ruby anniversary?', '40 years', 3)"
+            )
+            conn.commit()
+        for _ in range(100):
+            res = self.client().get("/questions/suggest?prefix=ruby")
+            if len(json.loads(res.data)["suggestions"]) > 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(json.loads(res.data)["suggestions"][0]["id"], 20)
+
     def test_delete_question(self):
         """
         Test DELETE /questions/<id>. We expect a HTTP 200 response, with JSON
@@ -309,5 +408,587 @@ class QuestionsTestCase(unittest.TestCase):
         self.assertEqual(data["error"], 400)
         self.assertEqual(data["message"], "Bad request")
 
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        """
+        Set up the test client, serving reads from a snapshot of the
+        test database.
+        """
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            "USE_SNAPSHOT": True,
+            "TEST_SNAPSHOT": os.path.join(self.tmp.name, "test-flaskr.snapshot"),
+        }, prod = False)
+        with self.app.app_context():
+            db.init_db()
+            snapshot.write_snapshot(
+                db.get_db(), self.app.config["TEST_SNAPSHOT"]
+            )
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_snapshot_is_world_readable(self):
+        """
+        Test that every worker can map the snapshot, whichever user built it
+        """
+        mode = os.stat(self.app.config["TEST_SNAPSHOT"]).st_mode
+        self.assertEqual(mode & 0o777, 0o644)
+
+    def test_get_questions_in_category(self):
+        """
+        Test GET /categories/<id>/questions is served from the snapshot
+        """
+        res = self.client().get("/categories/2/questions")
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["current_category"], "Art")
+        self.assertEqual([q["id"] for q in data["questions"]], [4, 5, 6, 7])
+        res = self.client().get("/categories/100/questions")
+        data = json.loads(res.data)
+        self.assertEqual(data["error"], 404)
+
+    def test_get_question_by_id(self):
+        """
+        Test GET /questions/<id> is served from the snapshot
+        """
+        res = self.client().get("/questions/1")
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["question"], {
+            "id": 1,
+            "category_id": 1,
+            "question": "What is the heaviest organ in the human body?",
+            "answer": "The liver",
+            "difficulty": 4,
+        })
+        res = self.client().get("/questions/1000")
+        data = json.loads(res.data)
+        self.assertEqual(data["error"], 404)
+
+    def test_get_categories(self):
+        """
+        Test GET /categories is served from the snapshot
+        """
+        res = self.client().get("/categories")
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["number_of_categories"], 6)
+        self.assertEqual(data["categories"][1], {"id": 2, "type": "Art"})
+
+    def test_quizzes_specific_category(self):
+        """
+        Test POST /quizzes samples from the snapshot's category index
+        """
+        res = self.client().post("/quizzes", json = {
+            "previous_questions": [4, 5, 6], "quiz_category": "art"
+        })
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["question"]["id"], 7)
+        res = self.client().post("/quizzes", json = {
+            "previous_questions": [4, 5, 6, 7], "quiz_category": "art"
+        })
+        data = json.loads(res.data)
+        self.assertEqual(data["question"], {})
+        res = self.client().post("/quizzes", json = {
+            "previous_questions": [], "quiz_category": "abc"
+        })
+        data = json.loads(res.data)
+        self.assertEqual(data["error"], 404)
+
+    def test_snapshot_refreshed_after_writes(self):
+        """
+        Test that creating and deleting questions regenerates the snapshot
+        """
+        res = self.client().post("/questions", json = {
+            "question": "How many years are celebrated with a ruby anniversary?",
+            "answer": "40",
+            "category_id": 4,
+            "difficulty": 3
+        })
+        created_id = json.loads(res.data)["created_id"]
+        self.wait_for_rebuild()
+        res = self.client().get(f"/questions/{created_id}")
+        data = json.loads(res.data)
+        self.assertEqual(data["question"]["answer"], "40")
+        self.client().delete(f"/questions/{created_id}")
+        self.wait_for_rebuild()
+        res = self.client().get(f"/questions/{created_id}")
+        data = json.loads(res.data)
+        self.assertEqual(data["error"], 404)
+
+    def wait_for_rebuild(self):
+        with self.app.app_context():
+            self.assertTrue(snapshot.get_rebuilder().wait(timeout = 5))
+
+    def test_rebuild_skipped_when_already_covered(self):
+        """
+        Test that a rebuild is skipped if a later one has already read the
+        bank, so a burst of writes across workers causes one rebuild
+        """
+        path = self.app.config["TEST_SNAPSHOT"]
+        since = time.time_ns()
+        with self.app.app_context():
+            self.assertTrue(
+                snapshot.write_snapshot(db.get_db(), path, since = since)
+            )
+            self.assertFalse(
+                snapshot.write_snapshot(db.get_db(), path, since = since)
+            )
+
+    def test_init_db_rebuilds_snapshot(self):
+        """
+        Test that resetting the database doesn't leave the snapshot serving
+        questions that are gone
+        """
+        res = self.client().post("/questions", json = {
+            "question": "How many years are celebrated with a ruby anniversary?",
+            "answer": "40",
+            "category_id": 4,
+            "difficulty": 3
+        })
+        created_id = json.loads(res.data)["created_id"]
+        self.wait_for_rebuild()
+        with self.app.app_context():
+            db.init_db()
+        res = self.client().get(f"/questions/{created_id}")
+        data = json.loads(res.data)
+        self.assertEqual(data["error"], 404)
+
+    def test_quizzes_non_string_category(self):
+        """
+        Test POST /quizzes with a category that isn't a string returns 404
+        """
+        res = self.client().post("/quizzes", json = {
+            "previous_questions": [], "quiz_category": 5
+        })
+        data = json.loads(res.data)
+        self.assertEqual(data["error"], 404)
+
+class AdmissionTestCase(unittest.TestCase):
+    def test_shed_when_route_is_full(self):
+        """
+        Test that a route with no free slots returns a fast 503 with
+        Retry-After, while other routes are unaffected
+        """
+        app = create_app({
+            "ADMISSION_LIMITS": {"play_quiz": 0},
+            "ADMISSION_QUEUE_TIMEOUT": 0,
+        }, prod = False)
+        with app.app_context():
+            db.init_db()
+        res = app.test_client().post("/quizzes", json = {
+            "previous_questions": []
+        })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers["Retry-After"], "1")
+        self.assertEqual(data["error"], 503)
+        res = app.test_client().get("/categories")
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+
+    def test_shed_when_queue_is_full(self):
+        """
+        Test that a request is shed immediately once the queue is full
+        """
+        limiter = admission.RouteLimiter(0, 0)
+        self.assertFalse(limiter.acquire(10))
+        limiter = admission.RouteLimiter(1, 0)
+        self.assertTrue(limiter.acquire(0))
+        limiter.release()
+
+    def test_rate_limit(self):
+        """
+        Test that clients are limited to their burst of requests
+        """
+        app = create_app({"RATE_LIMIT": (0.001, 2)}, prod = False)
+        with app.app_context():
+            db.init_db()
+        for _ in range(2):
+            res = app.test_client().get("/categories")
+            self.assertEqual(res.status_code, 200)
+        res = app.test_client().get("/categories")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data["error"], 429)
+        self.assertIn("Retry-After", res.headers)
+
+class BatchWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        """
+        Set up the test client, with question inserts batched.
+        """
+        self.app = create_app({"WRITE_BATCHING": True}, prod = False)
+        with self.app.app_context():
+            db.init_db()
+        self.client = self.app.test_client
+
+    def test_create_question(self):
+        """
+        Test POST /questions through the batch writer
+        """
+        res = self.client().post("/questions", json = {
+            "question": "How many years are celebrated with a ruby anniversary?",
+            "answer": "40",
+            "category_id": 4,
+            "difficulty": 3
+        })
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["created_id"], 20)
+        res = self.client().get("/questions/20")
+        data = json.loads(res.data)
+        self.assertEqual(data["question"]["answer"], "40")
+
+    def test_create_duplicate_question(self):
+        """
+        Test that a duplicate question is rejected with a 400, even if it
+        isn't caught by the near-duplicate check
+        """
+        self.app.config["DEDUP"] = "off"
+        res = self.client().post("/questions", json = {
+            "question": "Who discovered penicillin?",
+            "answer": "Alexander Fleming",
+            "category_id": 1,
+            "difficulty": 4
+        })
+        data = json.loads(res.data)
+        self.assertFalse(data["success"])
+        self.assertEqual(data["error"], 400)
+
+    def test_concurrent_inserts_are_grouped(self):
+        """
+        Test that concurrent inserts each get their own ID, and that a bad
+        insert doesn't fail the rest of its group
+        """
+        batch_writer = writer.BatchWriter(
+            self.app.config["TEST_DATABASE"], 10, 0.1
+        )
+        futures = [
+            batch_writer.submit(1, f"Question {i}?", "Answer", 1)
+            for i in range(5)
+        ]
+        futures.append(batch_writer.submit(1, "Question 0?", "Answer", 1))
+        self.assertEqual(
+            sorted(future.result() for future in futures[:5]),
+            [20, 21, 22, 23, 24]
+        )
+        with self.assertRaises(sqlite3.IntegrityError):
+            futures[5].result()
+
+    def test_create_question_timeout(self):
+        """
+        Test that a group commit which takes too long returns a 503
+        """
+        self.app.config["WRITE_TIMEOUT"] = 0
+        self.app.config["WRITE_BATCH_WINDOW"] = 0.5
+        res = self.client().post("/questions", json = {
+            "question": "How many years are celebrated with a ruby anniversary?",
+            "answer": "40",
+            "category_id": 4,
+            "difficulty": 3
+        })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data["error"], 503)
+        # Let the queued question commit before the next test resets the
+        # database
+        with self.app.app_context():
+            writer.get_writer().submit(
+                1, "Another question?", "Answer", 1
+            ).result(timeout = 5)
+
+    def test_writer_survives_failures(self):
+        """
+        Test that a writer which can't open its database fails each group,
+        rather than leaving requests waiting forever, and skips its hook
+        """
+        commits = []
+        batch_writer = writer.BatchWriter(
+            "/nonexistent/flaskr.sqlite", 10, 0, on_commit = commits.append
+        )
+        for _ in range(2):
+            future = batch_writer.submit(1, "Question?", "Answer", 1)
+            with self.assertRaises(sqlite3.OperationalError):
+                future.result(timeout = 5)
+        self.assertEqual(commits, [])
+
+class ShardsTestCase(unittest.TestCase):
+    def setUp(self):
+        """
+        Set up the test client, with questions spread across three shards.
+        """
+        self.app = create_app({"SHARD_COUNT": 3}, prod = False)
+        with self.app.app_context():
+            db.init_db()
+        self.client = self.app.test_client
+
+    def test_get_questions(self):
+        """
+        Test GET /questions gathers questions from every shard
+        """
+        res = self.client().get("/questions")
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["number_of_questions"], 19)
+        self.assertEqual(data["questions"][0], "What is the heaviest organ in the human body?")
+        res = self.client().get("/questions?search=title")
+        data = json.loads(res.data)
+        self.assertEqual(data["number_of_questions"], 2)
+        res = self.client().get("/questions?category=art")
+        data = json.loads(res.data)
+        self.assertEqual(data["number_of_questions"], 4)
+
+    def test_create_and_delete_question(self):
+        """
+        Test that created questions get unique IDs, and can be
+        found and deleted
+        """
+        res = self.client().post("/questions", json = {
+            "question": "How many years are celebrated with a ruby anniversary?",
+            "answer": "40",
+            "category_id": 4,
+            "difficulty": 3
+        })
+        data = json.loads(res.data)
+        self.assertEqual(data["created_id"], 20)
+        res = self.client().get("/questions/20")
+        data = json.loads(res.data)
+        self.assertEqual(data["question"]["category_id"], 4)
+        res = self.client().delete("/questions/20")
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        res = self.client().get("/questions/20")
+        data = json.loads(res.data)
+        self.assertEqual(data["error"], 404)
+
+    def test_quizzes_specific_category(self):
+        """
+        Test POST /quizzes in a category, served from its shard
+        """
+        res = self.client().post("/quizzes", json = {
+            "previous_questions": [4, 5, 6], "quiz_category": "art"
+        })
+        data = json.loads(res.data)
+        self.assertEqual(data["question"]["id"], 7)
+
+    def test_reshard(self):
+        """
+        Test that resharding keeps every question, and that new IDs come
+        after every existing question
+        """
+        with self.app.app_context():
+            conn = db.get_db()
+            source_paths = shards.get_shard_paths()
+            target_paths = shards.shard_paths(self.app.config["TEST_DATABASE"], 2)
+            shards.reshard(conn, source_paths, target_paths)
+            self.assertEqual(
+                len(shards.scatter(target_paths, "SELECT * FROM question ORDER BY id")),
+                19
+            )
+            shards.reshard(conn, target_paths, [])
+            self.assertEqual(
+                len(conn.execute("SELECT * FROM question").fetchall()), 19
+            )
+            self.assertEqual(shards.allocate_id(), 20)
+
+    def test_reshard_refused_while_app_is_running(self):
+        """
+        Test that the reshard command refuses to run while another process
+        holds the app lock, and runs once it has been released
+        """
+        path = self.app.config["TEST_DATABASE"] + ".lock"
+        runner = self.app.test_cli_runner()
+        with open(path, "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            with self.app.app_context():
+                result = runner.invoke(shards.reshard_command, ["2"])
+            self.assertNotEqual(result.exit_code, 0)
+            self.assertIn("Stop it before resharding", result.output)
+            self.assertEqual(len(shards.existing_shard_paths(
+                self.app.config["TEST_DATABASE"]
+            )), 3)
+        with self.app.app_context():
+            result = runner.invoke(shards.reshard_command, ["2"])
+        self.assertEqual(result.exit_code, 0)
+
+    def test_allocate_id_leases_blocks(self):
+        """
+        Test that IDs are leased from the main database in blocks, rather
+        than written to it for every insert
+        """
+        self.app.config["SHARD_ID_BLOCK"] = 10
+        with self.app.app_context():
+            ids = [shards.allocate_id() for _ in range(15)]
+            self.assertEqual(ids, list(range(20, 35)))
+            seq = db.get_db().execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'question_id'"
+            ).fetchone()[0]
+            self.assertEqual(seq, 39)
+
+class DedupTestCase(unittest.TestCase):
+    def setUp(self):
+        """
+        Set up the test client, using the test database.
+        """
+        self.app = create_app(prod = False)
+        with self.app.app_context():
+            db.init_db()
+        self.client = self.app.test_client
+
+    def test_create_exact_duplicate(self):
+        """
+        Test POST /questions with an existing question (up to case and
+        whitespace) returns a 409 naming the existing question
+        """
+        res = self.client().post("/questions", json = {
+            "question": "who  discovered PENICILLIN?",
+            "answer": "Alexander Fleming",
+            "category_id": 1,
+            "difficulty": 4
+        })
+        data = json.loads(res.data)
+        self.assertFalse(data["success"])
+        self.assertEqual(data["error"], 409)
+        self.assertEqual(data["duplicates"], [2])
+
+    def test_create_question_differing_in_punctuation(self):
+        """
+        Test that questions differing only in punctuation are near-duplicates,
+        flagged or rejected according to DEDUP, not exact duplicates
+        """
+        question = {
+            "question": "What is 2+2?",
+            "answer": "4",
+            "category_id": 1,
+            "difficulty": 1
+        }
+        res = self.client().post("/questions", json = question)
+        created_id = json.loads(res.data)["created_id"]
+        question["question"] = "What is 2-2?"
+        question["answer"] = "0"
+        self.app.config["DEDUP"] = "reject"
+        res = self.client().post("/questions", json = question)
+        data = json.loads(res.data)
+        self.assertEqual(data["error"], 409)
+        self.assertEqual(
+            data["message"], "Question is a near-duplicate of an existing question"
+        )
+        self.app.config["DEDUP"] = "flag"
+        res = self.client().post("/questions", json = question)
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["near_duplicates"], [created_id])
+
+    def test_create_near_duplicate(self):
+        """
+        Test that near-duplicates are flagged by default, and rejected in
+        "reject" mode
+        """
+        question = {
+            "question": "Which American painter was a pioneer of Abstract "
+                "Expressionism and a leading exponent of action painting?",
+            "answer": "Jackson Pollock",
+            "category_id": 2,
+            "difficulty": 2
+        }
+        self.app.config["DEDUP"] = "reject"
+        res = self.client().post("/questions", json = question)
+        data = json.loads(res.data)
+        self.assertEqual(data["error"], 409)
+        self.assertEqual(data["duplicates"], [7])
+        self.app.config["DEDUP"] = "flag"
+        res = self.client().post("/questions", json = question)
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["near_duplicates"], [7])
+        res = self.client().post("/questions", json = {
+            "question": "How many years are celebrated with a ruby anniversary?",
+            "answer": "40",
+            "category_id": 4,
+            "difficulty": 3
+        })
+        data = json.loads(res.data)
+        self.assertEqual(data["near_duplicates"], [])
+
+    def test_create_long_question_differing_in_one_word(self):
+        """
+        Test that a long question differing from an existing one only in a
+        number is flagged as a near-duplicate, not rejected as identical
+        """
+        text = (
+            "In the novel that begins with a storm over the harbour, which "
+            "character, having returned from years at sea with a fortune of "
+            "uncertain origin, confronts the magistrate who once condemned "
+            "his father, and what does he demand in exchange for his silence "
+            "about the events described in chapter {}?"
+        )
+        question = {
+            "question": text.format(1),
+            "answer": "A pardon",
+            "category_id": 5,
+            "difficulty": 5
+        }
+        res = self.client().post("/questions", json = question)
+        created_id = json.loads(res.data)["created_id"]
+        question["question"] = text.format(2)
+        res = self.client().post("/questions", json = question)
+        data = json.loads(res.data)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["near_duplicates"], [created_id])
+
+    def test_duplicates_across_shards(self):
+        """
+        Test that duplicates are found in other shards, and that the index
+        is written with the question in its shard
+        """
+        app = create_app({"SHARD_COUNT": 3, "WRITE_BATCHING": True}, prod = False)
+        with app.app_context():
+            db.init_db()
+        client = app.test_client()
+        res = client.post("/questions", json = {
+            "question": "Who discovered penicillin?",
+            "answer": "Alexander Fleming",
+            "category_id": 3,
+            "difficulty": 4
+        })
+        data = json.loads(res.data)
+        self.assertEqual(data["error"], 409)
+        self.assertEqual(data["duplicates"], [2])
+        res = client.post("/questions", json = {
+            "question": "What is the heaviest organ of the human body?",
+            "answer": "The liver",
+            "category_id": 3,
+            "difficulty": 4
+        })
+        data = json.loads(res.data)
+        self.assertEqual(data["near_duplicates"], [1])
+        with app.app_context():
+            indexed = dedup._each_location(lambda conn: conn.execute(
+                "SELECT question_id FROM question_signature WHERE question_id = 20"
+            ).fetchall())
+            self.assertEqual(sum(len(rows) for rows in indexed), 1)
+
+    def test_report(self):
+        """
+        Test that the dedup report finds near-duplicate pairs
+        """
+        runner = self.app.test_cli_runner()
+        with self.app.app_context():
+            result = runner.invoke(args = ["dedup-report"])
+        self.assertIn("Found 0 near-duplicate pairs.", result.output)
+        self.client().post("/questions", json = {
+            "question": "What is the heaviest organ of the human body?",
+            "answer": "The liver",
+            "category_id": 1,
+            "difficulty": 4
+        })
+        with self.app.app_context():
+            pairs = dedup.report([db.get_db()], 0.7)
+        self.assertEqual([pair[:2] for pair in pairs], [(1, 20)])
+
 if __name__ == "__main__":
     unittest.main()